@@ -9,13 +9,29 @@ Operates through Moonraker/Klipper protokol using HTTP
 '''
 
 from dataclasses import dataclass
-from typing import Optional, Dict, Any, Tuple,Literal
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
+from itertools import chain
+import asyncio
+from typing import Optional, Dict, Any, Tuple, Sequence, Union
+import math
 import time
-import requests
+import threading
+import numpy as np
 
+try:
+    from .moonraker_base import MoonrakerClient, PrinterError, _json_loads, _json_dumps
+except ImportError:  # запуск Printer.py как скрипта
+    from moonraker_base import MoonrakerClient, PrinterError, _json_loads, _json_dumps
 
-class PrinterError(RuntimeError):
-    pass
+# Готовые шаблоны G1: форматирование одним вызовом %-оператора на строку
+_G1_XYZ = "G1 X%.3f Y%.3f Z%.3f".__mod__
+_G1_XYZF = "G1 X%.3f Y%.3f Z%.3f F%d".__mod__
+
+try:
+    import websocket  # websocket-client, опционально: ожидание температуры по подписке вместо опроса
+except ImportError:
+    websocket = None
 
 
 @dataclass
@@ -55,181 +71,95 @@ class PrinterConfig:
         
         self.max_velocity_mm_s=200
         self.max_accel_mm_s2=500
+        # max_z_velocity из printer.cfg: Klipper ограничивает им Z-составляющую любого G1.
+        # Нужен только для оценки длительности пути; заниженное значение лишь удлиняет таймаут.
+        self.max_z_velocity_mm_s: float = 10.0
         
         self.safe_yx_speed_mm_s=100
         self.safe_z_speed_mm_s: float = 8.0
     
+        # Сжимать gzip тело POST с G-code длиннее стольких байт (длинные растры). None — не сжимать.
+        # Включайте, только если Moonraker принимает Content-Encoding: gzip.
+        self.gzip_gcode_min_bytes: Optional[int] = None
+    
         self.IP='10.2.15.109'
         self.base_url: str="http://"+self.IP+":7125"                  # например: "http://192.168.1.50:7125"
 
-class Printer:
+class Printer(MoonrakerClient):
     def __init__(self, params: PrinterConfig, *, auto_init: bool = True):
-        self.params = params
-        self.params.base_url="http://"+params.IP+":7125"                  # например: "http://192.168.1.50:7125"
-        self._limits: Optional[Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]] = None
+        params.base_url="http://"+params.IP+":7125"                  # например: "http://192.168.1.50:7125"
+        super().__init__(params)
+        # Пределы для точки toolhead с учётом габаритов насадки: (xmin, xmax, ymin, ymax, zmin, zmax)
+        self._eff_limits: Optional[Tuple[float, float, float, float, float, float]] = None
+        # Габариты насадки (attach_*), по которым посчитан _eff_limits
+        self._eff_attach: Optional[Tuple[float, ...]] = None
+        # Найденные имена объектов камеры (датчик / нагреватель), см. refresh_chamber_object()
+        self._chamber_obj: Optional[str] = None
+        self._chamber_heater_obj: Optional[str] = None
+        self._chamber_lock = threading.Lock()
         if auto_init:
             self.initialize()
 
-    # ---------------- HTTP ----------------
-    def _headers(self) -> Dict[str, str]:
-        h = {"Content-Type": "application/json"}
-        if self.params.api_key:
-            h["X-Api-Key"] = self.params.api_key
-        return h
-
-    def _url(self, path: str) -> str:
-        return self.params.base_url.rstrip("/") + path
-
-    def _get(self, path: str, params: Optional[dict] = None) -> Dict[str, Any]:
-        r = requests.get(self._url(path), params=params, headers=self._headers(), timeout=self.params.timeout)
-        if not r.ok:
-            raise PrinterError(f"GET {path} failed: {r.status_code} {r.text}")
-        return r.json()
-
-    def _post(self, path: str, payload: dict) -> Dict[str, Any]:
-        r = requests.post(self._url(path), json=payload, headers=self._headers(), timeout=self.params.timeout)
-        if not r.ok:
-            raise PrinterError(f"POST {path} failed: {r.status_code} {r.text}")
-        return r.json()
-
-    # ---------------- Status ----------------
-    def printer_info(self) -> Dict[str, Any]:
-        return self._get("/printer/info")["result"]
-
-    def query_status(self) -> Dict[str, Any]:
-        return self._get(
-            "/printer/objects/query",
-            params={"toolhead": "", "gcode_move": "", "print_stats": "", "webhooks": ""},
-        )["result"]["status"]
-
-    def _ensure_ready(self) -> None:
-        info = self.printer_info()
-        if info.get("state") != "ready":
-            raise PrinterError(f"Printer not ready: {info.get('state')} {info.get('state_message')}")
-
-    def _ensure_homed(self, axes: str = "xyz") -> None:
-        st = self.query_status()
-        homed = (st.get("toolhead", {}) or {}).get("homed_axes", "") or ""
-        for a in axes.lower():
-            if a not in homed.lower():
-                raise PrinterError(f"Axis '{a.upper()}' not homed. homed_axes='{homed}'. Run home() first.")
-
-    def wait_moves_m400(self) -> None:
-        self.send_gcode("M400")
-
-    def wait_moves(self, poll_interval: float = 0.2, timeout: float = 120.0) -> None:
-        t0 = time.time()
-        while True:
-            st = self.query_status()
-            if not bool(st.get("toolhead", {}).get("moving", False)):
-                return
-            if time.time() - t0 > timeout:
-                raise PrinterError("Timeout waiting for moves to finish")
-            time.sleep(poll_interval)
-   
-    def get_name(self):
-        result=self._get('/printer/info')
-        return result['hostname']
-    def get_position(self, *, source: Literal["toolhead", "gcode_move"] = "toolhead"):
-        """
-        Возвращает текущие координаты.
-    
-        source="toolhead":
-          printer.toolhead.position -> обычно "реальная" позиция по кинематике/степперам, [x,y,z,e]
-        source="gcode_move":
-          printer.gcode_move.position -> позиция в координатах gcode (с учетом G92/смещений), [x,y,z,e]
-    
-        Практически:
-          - для контроля фактического положения головы: toolhead
-          - если важны именно G-code координаты (после G92 и т.п.): gcode_move
-        """
-        self._ensure_ready()
-    
-        if source == "toolhead":
-            st = self._get(
-                "/printer/objects/query",
-                params={"toolhead": "position,homed_axes"},
-            )["result"]["status"]
-            th = st["toolhead"]
-            pos = th["position"]  # [x,y,z,e]
-        else:
-            st = self._get(
-                "/printer/objects/query",
-                params={"gcode_move": "position,homing_origin"},
-            )["result"]["status"]
-            gm = st["gcode_move"]
-            pos = gm["position"]  # [x,y,z,e]
-    
-        return {"x": float(pos[0]), "y": float(pos[1]), "z": float(pos[2]), "e": float(pos[3])}
-
     # ---------------- Init / limits cache ----------------
     def initialize(self) -> None:
-        self._ensure_ready()
-        self.refresh_limits()
+        # Готовность и пределы осей — из одного objects/query
+        st = self._ready_and_status()
+        self._ensure_ready(st)
+        self.refresh_limits(st)
         self._validate_attachment_box()
         self.set_motion_limits(velocity_mm_s=self.params.max_velocity_mm_s, accel_mm_s2=self.params.max_accel_mm_s2)
 
-    def refresh_limits(self) -> None:
-        st = self.query_status()
-        mn = st["toolhead"]["axis_minimum"]  # [xmin,ymin,zmin,emin]
-        mx = st["toolhead"]["axis_maximum"]  # [xmax,ymax,zmax,emax]
-        self._limits = (
-            (float(mn[0]), float(mx[0])),
-            (float(mn[1]), float(mx[1])),
-            (float(mn[2]), float(mx[2])),
-        )
+    def refresh_limits(self, status: Optional[Dict[str, Any]] = None) -> None:
+        super().refresh_limits(status)
+        self._update_effective_limits()
 
-    def get_limits_cached(self) -> Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]:
+    def _update_effective_limits(self) -> None:
+        """
+        Сдвигаем пределы поля на габариты насадки один раз, чтобы проверка точки
+        сводилась к одному сравнению по каждой оси. Вызывается из refresh_limits()
+        и set_attached_limits().
+        """
         if self._limits is None:
-            raise PrinterError("Limits are not initialized. Call initialize() or use auto_init=True.")
-        return self._limits
+            self._eff_limits = None
+            self._eff_attach = None
+            return
+        (xmin, xmax), (ymin, ymax), (zmin, zmax) = self._limits
+        ax0, ax1, ay0, ay1, az0, az1 = attach = self._attach_box()
+        self._eff_limits = (
+            xmin - ax0, xmax - ax1,
+            ymin - ay0, ymax - ay1,
+            zmin - az0, zmax - az1,
+        )
+        self._eff_attach = attach
+
+    def _attach_box(self) -> Tuple[float, float, float, float, float, float]:
+        p = self.params
+        return (float(p.attach_min_x), float(p.attach_max_x),
+                float(p.attach_min_y), float(p.attach_max_y),
+                float(p.attach_min_z), float(p.attach_max_z))
 
-    def _validate_attachment_box(self) -> None:
+    def _get_eff_limits(self) -> Tuple[float, float, float, float, float, float]:
+        """
+        Сдвинутые пределы; пересчитываем, если attach_* в params поменяли
+        напрямую (мимо set_attached_limits) после того, как пределы были посчитаны.
+        """
+        if self._eff_limits is None:
+            self.get_limits_cached()
+        if self._attach_box() != self._eff_attach:
+            self._validate_attachment_box()
+            self._update_effective_limits()
+        return self._eff_limits
+
+    def _validate_attachment_box(self, box: Optional[Tuple[float, ...]] = None) -> None:
         # Допускаем отрицательные значения (это нормально), но min должен быть <= max
-        for axis in ("x", "y", "z"):
-            mn = float(getattr(self.params, f"attach_min_{axis}"))
-            mx = float(getattr(self.params, f"attach_max_{axis}"))
+        if box is None:
+            box = self._attach_box()
+        for i, axis in enumerate(("x", "y", "z")):
+            mn, mx = box[2 * i], box[2 * i + 1]
             if mn > mx:
                 raise PrinterError(f"attach_min_{axis} must be <= attach_max_{axis} (got {mn} > {mx})")
-                
-    def _query_objects(self, objects: Dict[str, Any]) -> Dict[str, Any]:
-        """
-        Low-level helper to query arbitrary Klipper objects via Moonraker.
-        Example: objects={"heater_bed": None, "temperature_sensor chamber": None}
-        """
-        params = {k: "" for k in objects.keys()}
-        return self._get("/printer/objects/query", params=params)["result"]["status"]
-    # ---------------- G-code ----------------
-    def send_gcode(self, script: str) -> None:
-        self._post("/printer/gcode/script", {"script": script})
-                
-       
-    def find_properties(self, property_name:str) :
-        try:
-            objs = self._get("/printer/objects/list")["result"]["objects"]
-        except Exception:
-            objs = None
-
-        hint = ""
-        if isinstance(objs, list):
-            # Подскажем, что искать
-            chamber_like = [o for o in objs if property_name in o.lower()]
-            hint = f" Available objects containing {property_name}: {chamber_like}" if chamber_like else ""
-
-        return hint
-
-
-
 
     # ---------------- Thermals (Moonraker/Klipper) ----------------
-    @staticmethod
-    def _as_float(v: Any, name: str) -> float:
-        try:
-            return float(v)
-        except Exception as e:
-            raise PrinterError(f"Cannot convert {name}='{v}' to float") from e
-
-
     def get_bed_temperature(self) -> Tuple[float, Optional[float]]:
         """
         Returns (current, target) for heater_bed.
@@ -261,44 +191,105 @@ class Printer:
         cmd = "M190" if wait else "M140"
         self.send_gcode(f"{cmd} S{temp_c:.1f}")
         if wait:
-            self.wait_moves_m400()
-
-    def get_chamber_temperature(self, obj_name='temperature_sensor chamber_temp') -> Tuple[float, Optional[float]]:
+            self.wait_moves()
+
+    # Кандидаты имени объекта камеры в порядке предпочтения
+
+    _CHAMBER_SENSORS = (
+        "temperature_sensor chamber_temp",
+        "temperature_sensor chamber",
+        "heater_generic chamber_heater",
+        "heater_generic chamber",
+        "temperature_fan chamber",
+        "chamber",
+    )
+
+    _CHAMBER_HEATERS = (
+        "heater_generic chamber_heater",
+        "heater_generic chamber",
+        "temperature_fan chamber",
+    )
+
+    def _probe_objects(self, candidates: Tuple[str, ...]) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        Один objects/query на все кандидаты (Moonraker молча пропускает несуществующие объекты).
+        Возвращает (имя, данные) первого найденного в порядке candidates, либо (None, None).
+        Если список объектов принтера уже закэширован, запрашиваются только существующие.
+        """
+        objs = self._objects_list_if_fresh()
+        if objs is not None:
+            present = set(objs)
+            candidates = tuple(o for o in candidates if o in present)
+            if not candidates:
+                return None, None
+        st = self._query_objects(dict.fromkeys(candidates))
+        for obj in candidates:
+            data = st.get(obj)
+            if isinstance(data, dict) and "temperature" in data:
+                return obj, data
+        return None, None
+
+    def _discover_chamber(self, *, heater: bool = False) -> Tuple[Optional[str], Optional[Dict[str, Any]]]:
+        """
+        Как _probe_objects, но запоминает найденное имя: следующие вызовы
+        запрашивают только его. Если объект пропал (смена конфига) — пробуем заново.
+        """
+        attr = "_chamber_heater_obj" if heater else "_chamber_obj"
+        with self._chamber_lock:
+            cached = getattr(self, attr)
+        if cached is not None:
+            data = self._query_objects({cached: None}).get(cached)
+            if isinstance(data, dict) and "temperature" in data:
+                return cached, data
+        obj, data = self._probe_objects(self._CHAMBER_HEATERS if heater else self._CHAMBER_SENSORS)
+        with self._chamber_lock:
+            setattr(self, attr, obj)
+        return obj, data
+
+    def refresh_chamber_object(self) -> None:
+        """Forget discovered chamber object names (call after printer.cfg changes)."""
+        with self._chamber_lock:
+            self._chamber_obj = None
+            self._chamber_heater_obj = None
+        self._objects_list_cache = None
+
+    def get_chamber_temperature(self, obj_name: Optional[str] = None) -> Tuple[float, Optional[float]]:
         """
         Returns (current, target) for chamber temperature.
 
         In Klipper there is no single universal 'chamber' object name.
-        This method tries common variants in order:
-          1) temperature_sensor chamber
-          2) heater_generic chamber
-          3) temperature_fan chamber
-          4) chamber (rare/custom)
-          5)
+        If obj_name is None, all common variants are probed in ONE query and
+        the first present one is used, in order:
+          1) temperature_sensor chamber_temp
+          2) temperature_sensor chamber
+          3) heater_generic chamber_heater
+          4) heater_generic chamber
+          5) temperature_fan chamber
+          6) chamber (rare/custom)
 
         For temperature_sensor: only 'temperature' exists (no target) -> target=None
         For heater_generic:     'temperature' + 'target'
         For temperature_fan:    typically has 'temperature' and 'target' (depends on config)
 
-        If none found -> raises PrinterError with guidance.
-        """
-        
+        The found name is cached on the instance (see refresh_chamber_object()).
 
+        If none found -> returns (None, None).
+        """
         try:
-            st = self._query_objects({obj_name: None})
-            data = st.get(obj_name)
-            if isinstance(data, dict):
-                cur = self._as_float(data.get("temperature"), f"{obj_name}.temperature")
+            if obj_name is None:
+                obj, data = self._discover_chamber()
+            else:
+                obj, data = self._probe_objects((obj_name,))
+            if data is not None:
+                cur = self._as_float(data.get("temperature"), f"{obj}.temperature")
                 tgt = data.get("target", None)
-                tgt_f = None if tgt is None else self._as_float(tgt, f"{obj_name}.target")
+                tgt_f = None if tgt is None else self._as_float(tgt, f"{obj}.target")
                 return cur, tgt_f
         except Exception as e:
                 # last_err = e
                 # print(last_err)
                 return None,None
-
-
-      
-
+        return None, None
 
     def set_chamber_temperature(self, temp_c: float, *, wait: bool = False) -> None:
         """
@@ -313,7 +304,7 @@ class Printer:
         - If you configured chamber as temperature_fan:
             -> use SET_TEMPERATURE_FAN_TARGET TEMPERATURE_FAN=chamber TARGET=<temp>
 
-        This method tries both, by probing objects first.
+        This method probes both in one query (heater_generic preferred).
         If neither exists -> raises PrinterError.
         """
         self._ensure_ready()
@@ -321,44 +312,95 @@ class Printer:
         if temp_c < 0 or temp_c > 60:
             raise PrinterError(f"Chamber temperature out of expected range: {temp_c}C")
 
-        # Prefer heater_generic chamber if present
-        try:
-            st = self._query_objects({"heater_generic chamber_heater": None})
-            if isinstance(st.get("heater_generic chamber_heater"), dict):
-                self.send_gcode(f"SET_HEATER_TEMPERATURE HEATER=chamber TARGET={temp_c:.1f}")
-                if wait:
-                    # Простое ожидание: опрашиваем до достижения (с допуском)
-                    self._wait_chamber_reach(temp_c, tol=1.0, timeout_s=self.params.timeout)
-                return
-        except Exception:
-            pass
-
-        # Try temperature_fan chamber
         try:
-            st = self._query_objects({"temperature_fan chamber": None})
-            if isinstance(st.get("temperature_fan chamber"), dict):
-                self.send_gcode(f"SET_TEMPERATURE_FAN_TARGET TEMPERATURE_FAN=chamber TARGET={temp_c:.1f}")
-                if wait:
-                    self._wait_chamber_reach(temp_c, tol=1.0, timeout_s=self.params.timeout)
-                return
+            obj, _data = self._discover_chamber(heater=True)
         except Exception:
-            pass
+            obj = None
+
+        if obj is not None:
+            kind, name = obj.split(" ", 1)
+            if kind == "heater_generic":
+                self.send_gcode(f"SET_HEATER_TEMPERATURE HEATER={name} TARGET={temp_c:.1f}")
+            else:
+                self.send_gcode(f"SET_TEMPERATURE_FAN_TARGET TEMPERATURE_FAN={name} TARGET={temp_c:.1f}")
+            if wait:
+                # Простое ожидание: опрашиваем до достижения (с допуском)
+                self._wait_chamber_reach(temp_c, tol=1.0, timeout_s=self.params.timeout, obj_name=obj)
+            return
 
         raise PrinterError(
             "Cannot set chamber temperature: neither [heater_generic chamber] "
-            "nor [temperature_fan chamber] found in Klipper objects."
+            "nor [temperature_fan chamber] found in Klipper objects." + self.find_properties("chamber")
         )
 
-    def _wait_chamber_reach(self, target_c: float, *, tol: float = 1.0, timeout_s: float = 600.0, poll_s: float = 1.0) -> None:
+    def _wait_chamber_reach(self, target_c: float, *, tol: float = 1.0, timeout_s: float = 600.0, poll_s: float = 1.0,
+                            obj_name: Optional[str] = None) -> None:
+        """
+        Если установлен websocket-client — подписываемся на температуру через
+        Moonraker websocket (printer.objects.subscribe) и ждём push-обновлений.
+        Если подключиться не удалось — опрашиваем HTTP раз в poll_s секунд.
+        """
+        if obj_name is None:
+            obj_name, _data = self._discover_chamber()
+        if websocket is not None and obj_name is not None:
+            try:
+                ws = websocket.create_connection(
+                    self._ws_url(),
+                    timeout=self.params.timeout,
+                    header=[f"X-Api-Key: {self.params.api_key}"] if self.params.api_key else None,
+                )
+            except Exception:
+                ws = None
+            if ws is not None:
+                try:
+                    return self._wait_chamber_reach_ws(ws, obj_name, target_c, tol=tol, timeout_s=timeout_s)
+                finally:
+                    ws.close()
+
         t0 = time.time()
         while True:
-            cur, _tgt = self.get_chamber_temperature()
+            cur, _tgt = self.get_chamber_temperature(obj_name)
             if abs(cur - target_c) <= tol:
                 return
             if time.time() - t0 > timeout_s:
                 raise PrinterError(f"Timeout waiting for chamber to reach {target_c}C (current={cur}C)")
             time.sleep(poll_s)
 
+    def _wait_chamber_reach_ws(self, ws, obj_name: str, target_c: float, *, tol: float, timeout_s: float) -> None:
+        ws.send(_json_dumps({
+            "jsonrpc": "2.0",
+            "method": "printer.objects.subscribe",
+            "params": {"objects": {obj_name: ["temperature"]}},
+            "id": 1,
+        }))
+        t0 = time.time()
+        cur = None
+        while True:
+            remaining = timeout_s - (time.time() - t0)
+            if remaining <= 0:
+                raise PrinterError(f"Timeout waiting for chamber to reach {target_c}C (current={cur}C)")
+            ws.settimeout(remaining)
+            try:
+                msg = _json_loads(ws.recv())
+            except websocket.WebSocketTimeoutException:
+                continue
+
+            if msg.get("id") == 1:
+                if "error" in msg:
+                    raise PrinterError(f"Chamber subscription failed: {msg['error']}")
+                status = msg["result"]["status"]
+            elif msg.get("method") == "notify_status_update":
+                status = msg["params"][0]
+            else:
+                continue
+
+            t = (status.get(obj_name) or {}).get("temperature")
+            if t is None:
+                continue
+            cur = self._as_float(t, f"{obj_name}.temperature")
+            if abs(cur - target_c) <= tol:
+                return
+
     def home(self, axes: str = "XYZ", *, confirm: bool = True) -> None:
         """
         Выполнить homing (G28), но только после явного подтверждения в консоли,
@@ -379,23 +421,74 @@ class Printer:
             if ans != "CONFIRM":
                 raise PrinterError("Homing cancelled by user (confirmation not received).")
 
-        self.send_gcode(f"G28 {axes.upper()}")
-        self.wait_moves_m400()
-        self.move_absolute(x=self._limits[0][1]/2,y=self._limits[1][1]/2, z=self._limits[2][1]-10,speed_mm_s=50)
-
+        # G28 и отъезд в центр поля — одним скриптом (один POST)
+        (xmin, xmax), (ymin, ymax), (zmin, zmax) = self.get_limits_cached()
+        x, y, z = xmax/2, ymax/2, zmax-10
+        self._check_xyz_with_attachment(x, y, z)
+        F = int(50 * 60.0)
+        # POST вернётся только после обоих M400: оцениваем homing с запасом (каждая ось —
+        # весь ход на safe-скорости, оси по очереди) плюс отъезд в центр через всё поле
+        p = self.params
+        homing = sum(
+            (hi - lo) / (p.safe_z_speed_mm_s if ax == "Z" else p.safe_yx_speed_mm_s)
+            for ax, lo, hi in (("X", xmin, xmax), ("Y", ymin, ymax), ("Z", zmin, zmax))
+            if ax in axes.upper()
+        )
+        travel = math.dist((xmin, ymin), (xmax, ymax)) / 50 + (zmax - zmin) / min(50, p.max_z_velocity_mm_s)
+        self.send_gcode("\n".join([
+            f"G28 {axes.upper()}",
+            "M400",
+            "G90",
+            _G1_XYZF((x, y, z, F)),
+            "M400",
+        ]), motion_s=homing + travel)
 
     # ---------------- Validation helpers ----------------
-    @staticmethod
-    def _range_check(v: float, lo: float, hi: float, name: str) -> None:
-        if v < lo or v > hi:
-            raise PrinterError(f"{name}={v:.3f} out of range [{lo:.3f}, {hi:.3f}]")
-
     def _check_xyz_with_attachment(self, x: float, y: float, z: float) -> None:
         """
         Проверяем, что bounding-box насадки целиком в пределах рабочего поля.
         """
+        exmin, exmax, eymin, eymax, ezmin, ezmax = self._get_eff_limits()
+        if not (exmin <= x <= exmax and eymin <= y <= eymax and ezmin <= z <= ezmax):
+            self._raise_oob(x, y, z)
+
+    def _bad_points(self, pts: np.ndarray) -> np.ndarray:
+        """
+        Индексы точек массива (N, 3), не прошедших быструю проверку (пустой массив — всё в поле).
+        Одна векторная маска по всем шести границам вместо цикла по точкам; NaN в маску не проходит.
+        """
+        exmin, exmax, eymin, eymax, ezmin, ezmax = self._get_eff_limits()
+        x, y, z = pts[:, 0], pts[:, 1], pts[:, 2]
+        ok = np.logical_and.reduce((x >= exmin, x <= exmax, y >= eymin, y <= eymax, z >= ezmin, z <= ezmax))
+        return np.flatnonzero(~ok)
+
+    def _check_points_with_attachment(self, pts: np.ndarray, name: str = "points", stride: int = 1) -> None:
+        """
+        То же, что _check_xyz_with_attachment, но для массива точек (N, 3) разом.
+        stride — сколько строк pts приходится на один элемент name (для сообщения об ошибке).
+        """
+        if not np.isfinite(pts).all():
+            i = int(np.argmax(~np.isfinite(pts).all(axis=1)))
+            raise PrinterError(f"{name}[{i // stride}]: non-finite coordinate {pts[i].tolist()}")
+        # Каждую отбракованную строку проверяем точно: пропуск на границе (округление)
+        # не должен оставить следующие точки без проверки
+        for i in self._bad_points(pts).tolist():
+            try:
+                self._raise_oob(*pts[i].tolist())
+            except PrinterError as e:
+                raise PrinterError(f"{name}[{i // stride}]: {e}") from None
+
+    def _raise_oob(self, x: float, y: float, z: float) -> None:
+        """
+        Холодный путь: точка вне поля. Повторяем проверку по углам насадки,
+        чтобы сообщение указало, какой именно край вышел за пределы.
+        Эта проверка точная, поэтому на самой границе (округление при сдвиге
+        пределов) она может и пропустить точку — тогда просто возвращаемся.
+        """
+        if not (math.isfinite(x) and math.isfinite(y) and math.isfinite(z)):
+            raise PrinterError(f"Non-finite coordinate: X={x} Y={y} Z={z}")
         (xmin, xmax), (ymin, ymax), (zmin, zmax) = self.get_limits_cached()
-        
+
         # Координаты крайних точек насадки, 
         x0 = x + float(self.params.attach_min_x)
         x1 = x + float(self.params.attach_max_x)
@@ -411,14 +504,7 @@ class Printer:
         self._range_check(z0, zmin+additional_shift, zmax-additional_shift, "Z+attach_min_z")
         self._range_check(z1, zmin+additional_shift, zmax-additional_shift, "Z+attach_max_z")
 
-    # ---------------- Motion limits ----------------
-    def set_motion_limits(self, velocity_mm_s: float, accel_mm_s2: float) -> None:
-        self._ensure_ready()
-        if velocity_mm_s <= 0 or accel_mm_s2 <= 0:
-            raise PrinterError("velocity_mm_s and accel_mm_s2 must be > 0")
-        self.send_gcode(f"SET_VELOCITY_LIMIT VELOCITY={velocity_mm_s:.3f} ACCEL={accel_mm_s2:.1f}")
-
-
+    # ---------------- Attachment ----------------
     def set_attached_limits(self,
                             min_x=None,
                             max_x=None,
@@ -426,32 +512,41 @@ class Printer:
                             max_y=None,
                             min_z=None,
                             max_z=None):
-        if min_x!=None:
-            self.params.attach_min_x = min_x
-        if max_x!=None:
-            self.params.attach_max_x = max_x
         '''
         Если вперёд по Y выступ 20 мм, назад 0:
         attach_min_y = 0, attach_max_y = +20
-        '''
-        if min_y!=None:
-            self.params.attach_min_y= min_y
-        if max_y!=None:
-            self.params.attach_max_y= max_y
-        '''
         Если колесо ниже сопла на 12 мм (выступ вниз, т.е. к столу), и вверх насадка не выступает:
         attach_min_z = -12, attach_max_z = 0
         '''
-        if min_z!=None:
-            self.params.attach_min_z =min_z
-        if max_z!=None:
-            self.params.attach_max_z =max_z
-        
-        
+        new = (min_x, max_x, min_y, max_y, min_z, max_z)
+        box = tuple(cur if v is None else float(v) for v, cur in zip(new, self._attach_box()))
+        # Сначала проверяем новые габариты и только потом пишем их в params,
+        # чтобы при ошибке не остаться с наполовину обновлённой насадкой
+        self._validate_attachment_box(box)
+        (self.params.attach_min_x, self.params.attach_max_x,
+         self.params.attach_min_y, self.params.attach_max_y,
+         self.params.attach_min_z, self.params.attach_max_z) = box
+        self._update_effective_limits()
+
     # ---------------- Moves ----------------
+    def _move_time_bound(self, speed_mm_s: float, x: Optional[float] = None,
+                         y: Optional[float] = None, z: Optional[float] = None) -> float:
+        """
+        Верхняя оценка длительности G1 в точку (x, y, z) из любой точки поля: текущая
+        позиция внутри fast_move_session() / gcode_batch() может быть устаревшей.
+        None — ось не движется. Z ограничен max_z_velocity, как в Klipper.
+        """
+        (xmin, xmax), (ymin, ymax), (zmin, zmax) = self.get_limits_cached()
+
+        def far(v: Optional[float], lo: float, hi: float) -> float:
+            return 0.0 if v is None else max(v - lo, hi - v, 0.0)
+
+        t_xy = math.hypot(far(x, xmin, xmax), far(y, ymin, ymax)) / speed_mm_s
+        t_z = far(z, zmin, zmax) / min(speed_mm_s, float(self.params.max_z_velocity_mm_s))
+        return max(t_xy, t_z)
+
     def move_absolute(self, *, x: float, y: float, z: float, speed_mm_s: float, wait: bool = True) -> None:
-        self._ensure_ready()
-        self._ensure_homed("xyz")
+        self._preflight("xyz")
 
         if speed_mm_s <= 0:
             raise PrinterError("speed_mm_s must be > 0")
@@ -460,32 +555,37 @@ class Printer:
         self._check_xyz_with_attachment(x, y, z)
 
         F = int(speed_mm_s * 60.0)
-        self.send_gcode("\n".join([
+        lines = [
             "G90",
-            f"G1 X{x:.3f} Y{y:.3f} Z{z:.3f} F{F}",
-        ]))
-        if wait:
-            self.wait_moves_m400()
-            
+            _G1_XYZF((x, y, z, F)),
+        ]
+        if not wait:
+            self.send_gcode("\n".join(lines))
+            return
+        lines.append("M400")
+        self.send_gcode("\n".join(lines), motion_s=self._move_time_bound(speed_mm_s, x, y, z))
+
     def move_z(self, *, z: float, speed_mm_s: float=None, wait: bool = True) -> None:
-        self._ensure_ready()
-        self._ensure_homed("xyz")
+        st = self._preflight("xyz")
         
         if speed_mm_s==None:
             speed_mm_s=self.params.safe_z_speed_mm_s
         if speed_mm_s <= 0:
             raise PrinterError("speed_mm_s must be > 0")
 
-        cur = self.get_position(source="toolhead")
-        self._check_xyz_with_attachment(cur["x"], cur["y"], z)
+        cur_x, cur_y, _cur_z = self._toolhead_xyz(st)
+        self._check_xyz_with_attachment(cur_x, cur_y, z)
 
         F = int(speed_mm_s * 60.0)
-        self.send_gcode("\n".join([
+        lines = [
             "G90",
-            f"G1 Z{z:.3f} F{F}",
-        ]))
-        if wait:
-            self.wait_moves_m400()
+            "G1 Z%.3f F%d" % (z, F),
+        ]
+        if not wait:
+            self.send_gcode("\n".join(lines))
+            return
+        lines.append("M400")
+        self.send_gcode("\n".join(lines), motion_s=self._move_time_bound(speed_mm_s, z=z))
 
     def safe_y_pass(
         self,
@@ -503,8 +603,7 @@ class Printer:
         z_safe задаёте явно (в воздухе). Код проверит, что с учётом насадки
         и на z_safe, и на z_contact ничего не выходит за пределы.
         """
-        self._ensure_ready()
-        self._ensure_homed("xyz")
+        self._preflight("xyz")
 
 
 
@@ -525,18 +624,158 @@ class Printer:
         F_approach = int(self.params.safe_yx_speed_mm_s * 60.0)
         F_travel = int(self.params.safe_yx_speed_mm_s * 60.0)
 
-        script = "\n".join([
+        lines = [
             "G90",
-            f"G1 Z{z_safe:.3f} F{Fz}",
-            f"G1 X{x:.3f} Y{y_start:.3f} F{F_approach}",
-            f"G1 Z{z_contact:.3f} F{Fz}",
-            f"G1 Y{y_end:.3f} F{F_travel}",  # строго по Y
-            f"G1 Z{z_safe:.3f} F{Fz}",
-        ])
-        self.send_gcode(script)
+            "G1 Z%.3f F%d" % (z_safe, Fz),
+            "G1 X%.3f Y%.3f F%d" % (x, y_start, F_approach),
+            "G1 Z%.3f F%d" % (z_contact, Fz),
+            "G1 Y%.3f F%d" % (y_end, F_travel),  # строго по Y
+            "G1 Z%.3f F%d" % (z_safe, Fz),
+        ]
+        if not wait:
+            self.send_gcode("\n".join(lines))
+            return
+        lines.append("M400")
+        # Подъём и подход к y_start — из неизвестной позиции (оценка сверху),
+        # дальше два хода по Z и проход по Y известной длины
+        p = self.params
+        duration = self._move_time_bound(p.safe_z_speed_mm_s, z=z_safe) \
+            + self._move_time_bound(p.safe_yx_speed_mm_s, x, y_start) \
+            + 2 * abs(z_safe - z_contact) / p.safe_z_speed_mm_s + abs(y_end - y_start) / p.safe_yx_speed_mm_s
+        self.send_gcode("\n".join(lines), motion_s=duration)
+
+    def move_path(self, points: Union[Sequence[Tuple[float, float, float]], np.ndarray], *, speed_mm_s: float, wait: bool = True) -> None:
+        """
+        Последовательность прямолинейных G1-перемещений по точкам (x, y, z) одним POST.
 
-        if wait:
-            self.wait_moves_m400()
+        points — последовательность (x, y, z) или массив формы (N, 3).
+        Все точки проверяются с учётом габаритов насадки одной операцией NumPy до отправки.
+        Переход к первой точке — тоже по прямой из текущей позиции, поэтому
+        подводить голову к началу пути (например, через safe_y_pass) нужно заранее.
+        """
+        self._preflight("xyz")
+        if speed_mm_s <= 0:
+            raise PrinterError("speed_mm_s must be > 0")
+
+        arr = np.asarray(points, dtype=np.float64)
+        if arr.size == 0:
+            return
+        if arr.ndim != 2 or arr.shape[1] != 3:
+            raise PrinterError(f"points must have shape (N, 3), got {arr.shape}")
+        self._check_points_with_attachment(arr)
+        points = list(map(tuple, arr.tolist()))
+
+        F = int(speed_mm_s * 60.0)
+        # F задаём один раз: Klipper запоминает скорость для следующих G1
+        script = "\n".join(chain(("G90", "G1 F%d" % F), map(_G1_XYZ, points), ("M400",) if wait else ()))
+        if not wait:
+            self.send_gcode(script)
+            return
+        # Длительность пути без подхода к первой точке — его покрывает запас params.timeout.
+        # Z Klipper ограничивает max_z_velocity, поэтому для каждого отрезка берём
+        # большее из времени по XY на speed_mm_s и по Z на min(speed_mm_s, max_z_velocity)
+        d = np.diff(arr, axis=0)
+        t_xy = np.hypot(d[:, 0], d[:, 1]) / speed_mm_s
+        t_z = np.abs(d[:, 2]) / min(speed_mm_s, float(self.params.max_z_velocity_mm_s))
+        duration = float(np.maximum(t_xy, t_z).sum())
+        self.send_gcode(script, motion_s=duration)
+
+    def safe_y_passes(
+        self,
+        xs,
+        *,
+        y_start: float,
+        y_end: float,
+        z_safe: float,
+        z_contact: float,
+        wait: bool = True,
+    ) -> None:
+        """
+        Серия safe_y_pass по набору X (растровый проход) одним G-code скриптом.
+
+        Все ключевые точки всех проходов проверяются одной векторной операцией NumPy,
+        весь скрипт уходит одним POST.
+        """
+        self._preflight("xyz")
+
+        xs = np.asarray(xs, dtype=np.float64).ravel()
+        if xs.size == 0:
+            return
+        y_start = float(y_start)
+        y_end = float(y_end)
+        z_safe = float(z_safe)
+        z_contact = float(z_contact)
+
+        # Все четыре ключевые точки каждого прохода — одним массивом (4N, 3) и одной маской
+        corners = np.array([(y_start, z_safe), (y_end, z_safe), (y_start, z_contact), (y_end, z_contact)])
+        pts = np.column_stack([np.repeat(xs, 4), np.tile(corners[:, 0], xs.size), np.tile(corners[:, 1], xs.size)])
+        self._check_points_with_attachment(pts, name="xs", stride=4)
+
+        Fz = int(self.params.safe_z_speed_mm_s * 60.0)
+        F_approach = int(self.params.safe_yx_speed_mm_s * 60.0)
+        F_travel = int(self.params.safe_yx_speed_mm_s * 60.0)
+
+        # Всё, кроме X, одинаково для каждого прохода — форматируем один раз
+        approach = ("G1 X%%.3f Y%.3f F%d" % (y_start, F_approach)).__mod__
+        lift = "G1 Z%.3f F%d" % (z_safe, Fz)
+        contact = "G1 Z%.3f F%d" % (z_contact, Fz)
+        travel = "G1 Y%.3f F%d" % (y_end, F_travel)  # строго по Y
+
+        # Между проходами голова уже на z_safe после подъёма — повторный подъём не нужен
+        lines = ["G90", lift]
+        for x in xs.tolist():
+            lines += (approach(x), contact, travel, lift)
+        if not wait:
+            self.send_gcode("\n".join(lines))
+            return
+        lines.append("M400")
+        # Оценка времени: два хода по Z, проход по Y, возврат к y_start и шаг по X на каждый проход
+        dz = abs(z_safe - z_contact)
+        dy = abs(y_end - y_start)
+        dx = float(np.abs(np.diff(xs)).sum())
+        duration = xs.size * (2 * dz / self.params.safe_z_speed_mm_s + 2 * dy / self.params.safe_yx_speed_mm_s) \
+            + dx / self.params.safe_yx_speed_mm_s
+        self.send_gcode("\n".join(lines), motion_s=duration)
+
+
+class AsyncPrinter:
+    """
+    asyncio-обёртка над Printer: каждый метод выполняется в собственном потоке принтера
+    (ThreadPoolExecutor на один поток), поэтому один event loop может вести несколько
+    принтеров одновременно, не упираясь в общий пул loop.run_in_executor(None, ...):
+
+        printers = [AsyncPrinter(Printer(cfg)) for cfg in configs]
+        await asyncio.gather(*(ap.move_path(pts, speed_mm_s=50) for ap in printers))
+
+    Вызовы к одному принтеру выполняются по очереди (один поток), к разным — параллельно.
+    Контекстные менеджеры (gcode_batch, fast_move_session) используйте на самом Printer.
+    """
+    _SYNC_ONLY = frozenset(("gcode_batch", "fast_move_session"))
+
+    def __init__(self, printer: Printer):
+        self.printer = printer
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="printer")
+
+    def __getattr__(self, name: str):
+        if name in self._SYNC_ONLY:
+            raise AttributeError(f"{name}() is a context manager; use it on AsyncPrinter.printer")
+        attr = getattr(self.printer, name)
+        if not callable(attr):
+            return attr
+
+        async def call(*args, **kwargs):
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self._executor, partial(attr, *args, **kwargs))
+        return call
+
+    async def __aenter__(self) -> "AsyncPrinter":
+        return self
+
+    async def __aexit__(self, *exc) -> None:
+        try:
+            await asyncio.get_running_loop().run_in_executor(self._executor, self.printer.close)
+        finally:
+            self._executor.shutdown(wait=False)
       #%%
 if __name__=='__main__':
 
@@ -572,12 +811,12 @@ if __name__=='__main__':
     p.home("XYZ")
     p.set_motion_limits(velocity_mm_s=100, accel_mm_s2=500)
     #%%
-    for x in [100,200,300]:
-        p.safe_y_pass(
-        x=x,
-        y_start=20,
-        y_end=250,
-        z_safe=50,
-        z_contact=40,          # подобрать экспериментально!
-        travel_speed_mm_s=60,
-        )
\ No newline at end of file
+    with p.gcode_batch():
+        for x in [100,200,300]:
+            p.safe_y_pass(
+            x=x,
+            y_start=20,
+            y_end=250,
+            z_safe=50,
+            z_contact=40,          # подобрать экспериментально!
+            )
\ No newline at end of file
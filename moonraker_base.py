@@ -0,0 +1,415 @@
+from __future__ import annotations
+
+'''
+Shared Moonraker HTTP client: session, status/readiness checks, limits cache, G-code.
+Printer-specific logic (attachment box, thermals, moves) lives in Printer.py.
+'''
+
+from contextlib import contextmanager
+from typing import Optional, Dict, Any, Tuple, List, Iterator, Literal
+import time
+import threading
+import json
+import gzip
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+try:
+    import orjson  # опционально: заметно быстрее разбирает ответы objects/query
+    _json_loads = orjson.loads
+    _json_dumps = orjson.dumps
+except ImportError:
+    orjson = None
+    _json_loads = json.loads
+    _json_dumps = json.dumps
+
+
+class PrinterError(RuntimeError):
+    pass
+
+
+class MoonrakerClient:
+    def __init__(self, params):
+        self.params = params
+        self._limits: Optional[Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]] = None
+        self._base = self.params.base_url.rstrip("/")
+        self._session = self._make_session()
+        # Короткий TTL-кэш готовности принтера для _ensure_ready(), см. invalidate_info_cache()
+        self._info_cache: Optional[Tuple[float, Dict[str, Any]]] = None
+        self._info_ttl = 1.0
+        self._info_lock = threading.Lock()
+        # Буфер G-code внутри gcode_batch(): None — команды отправляются сразу
+        self._gcode_buffer: Optional[List[str]] = None
+        # Суммарное время движения скриптов пакета, с; None — таймаут по умолчанию
+        self._gcode_buffer_motion: Optional[float] = None
+        # Готовые params для однообъектных запросов (heater_bed, найденная камера)
+        self._single_query_params: Dict[str, Dict[str, str]] = {}
+        # (время, список) для /printer/objects/list — список объектов меняется только с конфигом
+        self._objects_list_cache: Optional[Tuple[float, List[str]]] = None
+        # Результат _preflight() внутри fast_move_session(): None — проверки на каждый вызов
+        self._preflight_status: Optional[Dict[str, Any]] = None
+
+    # ---------------- HTTP ----------------
+    def _make_session(self) -> requests.Session:
+        # Одна keep-alive сессия на принтер: опросы Moonraker не открывают новое TCP-соединение на каждый запрос.
+        # Переход на HTTP/2 (например, httpx) здесь ничего не даёт: сервер Moonraker на Tornado говорит
+        # только HTTP/1.1, поэтому ни ALPN, ни h2c с prior knowledge (http1=False, http2=True) с ним
+        # не сработают. Параллельные запросы из разных потоков и так идут по разным соединениям пула
+        # (pool_maxsize=8).
+        # Короткие повторы только для идемпотентных запросов (POST G-code Retry по умолчанию не повторяет);
+        # raise_on_status=False — последний ответ вернётся в _get и станет PrinterError.
+        retry = Retry(total=2, backoff_factor=0.1, status_forcelist=(502, 503, 504), raise_on_status=False)
+        s = requests.Session()
+        s.mount("http://", HTTPAdapter(pool_connections=4, pool_maxsize=8, max_retries=retry))
+        # Заголовок Connection не трогаем: keep-alive — поведение по умолчанию
+        s.headers.update(self._build_headers())
+        return s
+
+    def set_api_key(self, api_key: Optional[str]) -> None:
+        self.params.api_key = api_key
+        self.refresh_config()
+
+    def refresh_config(self) -> None:
+        """Re-read params.base_url / params.api_key after they were changed on a live instance."""
+        self._base = self.params.base_url.rstrip("/")
+        self._session.headers.pop("X-Api-Key", None)
+        self._session.headers.update(self._build_headers())
+
+    def close(self) -> None:
+        self._session.close()
+
+    def __enter__(self) -> "MoonrakerClient":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def _build_headers(self) -> Dict[str, str]:
+        # Заголовки живут в self._session.headers; собираются только в __init__ и refresh_config()
+        h = {"Content-Type": "application/json"}
+        if self.params.api_key:
+            h["X-Api-Key"] = self.params.api_key
+        return h
+
+    def _get(self, path: str, params: Optional[dict] = None) -> Dict[str, Any]:
+        r = self._session.get(self._base + path, params=params, timeout=self.params.timeout)
+        if not r.ok:
+            raise PrinterError(f"GET {path} failed: {r.status_code} {r.text}")
+        return _json_loads(r.content)
+
+    def _post(self, path: str, payload: dict, timeout: Optional[float] = None, *, compress: bool = False) -> Dict[str, Any]:
+        body = _json_dumps(payload)
+        headers = None
+        if compress:
+            # Сжатие тела включается только явно (params.gzip_gcode_min_bytes): Moonraker должен
+            # уметь принимать Content-Encoding: gzip — проверьте на своей установке
+            min_bytes = getattr(self.params, "gzip_gcode_min_bytes", None)
+            if isinstance(body, str):
+                body = body.encode("utf-8")
+            if min_bytes is not None and len(body) > min_bytes:
+                body = gzip.compress(body)
+                headers = {"Content-Encoding": "gzip"}
+        r = self._session.post(self._base + path, data=body, headers=headers, timeout=self.params.timeout if timeout is None else timeout)
+        if not r.ok:
+            raise PrinterError(f"POST {path} failed: {r.status_code} {r.text}")
+        return _json_loads(r.content)
+
+    def _ws_url(self) -> str:
+        base = self._base
+        return "ws" + base[len("http"):] + "/websocket" if base.startswith("http") else base + "/websocket"
+
+    # ---------------- Status ----------------
+    _STATUS_PARAMS = {"toolhead": "", "gcode_move": "", "print_stats": "", "webhooks": ""}
+    # Только поля, нужные проверкам перед движением и initialize(): ответ в разы короче полного статуса
+    _PREFLIGHT_PARAMS = {"webhooks": "state,state_message", "toolhead": "homed_axes,position,axis_minimum,axis_maximum"}
+    _POSITION_PARAMS = {"toolhead": "position"}
+    _HOMED_PARAMS = {"toolhead": "homed_axes"}
+
+    def printer_info(self) -> Dict[str, Any]:
+        return self._get("/printer/info")["result"]
+
+    def query_status(self) -> Dict[str, Any]:
+        return self._get("/printer/objects/query", params=self._STATUS_PARAMS)["result"]["status"]
+
+    def _ready_and_status(self) -> Dict[str, Any]:
+        """
+        Один запрос вместо printer_info() + query_status():
+        webhooks.state/state_message несут ту же готовность, что и /printer/info.
+        Запрашиваются только поля webhooks и toolhead, нужные проверкам (см. _PREFLIGHT_PARAMS).
+        """
+        return self._get("/printer/objects/query", params=self._PREFLIGHT_PARAMS)["result"]["status"]
+
+    def _query_position(self) -> List[float]:
+        return self._get("/printer/objects/query", params=self._POSITION_PARAMS)["result"]["status"]["toolhead"]["position"]
+
+    def _query_homed_axes(self) -> str:
+        st = self._get("/printer/objects/query", params=self._HOMED_PARAMS)["result"]["status"]
+        return (st.get("toolhead", {}) or {}).get("homed_axes", "") or ""
+
+    def _ensure_ready(self, status: Optional[Dict[str, Any]] = None) -> None:
+        fresh = True
+        if status is not None:
+            info = status.get("webhooks", {}) or {}
+        else:
+            with self._info_lock:
+                cached = self._info_cache
+            if cached is not None and time.time() - cached[0] < self._info_ttl:
+                info = cached[1]
+                fresh = False
+            else:
+                info = self.printer_info()
+        if info.get("state") != "ready":
+            self.invalidate_info_cache()
+            raise PrinterError(f"Printer not ready: {info.get('state')} {info.get('state_message')}")
+        # Метку времени обновляем только для ответа сервера: попадание в кэш
+        # не должно продлевать TTL
+        if fresh:
+            with self._info_lock:
+                self._info_cache = (time.time(), info)
+
+    def invalidate_info_cache(self) -> None:
+        with self._info_lock:
+            self._info_cache = None
+
+    def _ensure_homed(self, axes: str = "xyz", status: Optional[Dict[str, Any]] = None) -> None:
+        if status is None:
+            homed = self._query_homed_axes()
+        else:
+            homed = (status.get("toolhead", {}) or {}).get("homed_axes", "") or ""
+        for a in axes.lower():
+            if a not in homed.lower():
+                raise PrinterError(f"Axis '{a.upper()}' not homed. homed_axes='{homed}'. Run home() first.")
+
+    def _preflight(self, axes: str = "xyz") -> Dict[str, Any]:
+        """
+        Все проверки перед движением по одному objects/query: готовность (webhooks),
+        хоминг (toolhead.homed_axes) и, если ещё не прочитаны, пределы осей.
+        Возвращает status; позицию из него брать через _toolhead_xyz().
+        Внутри fast_move_session() возвращает закэшированный status без запроса.
+        """
+        if self._preflight_status is not None:
+            return self._preflight_status
+        st = self._ready_and_status()
+        self._ensure_ready(st)
+        self._ensure_homed(axes, st)
+        if self._limits is None:
+            self.refresh_limits(st)
+        return st
+
+    def _toolhead_xyz(self, status: Dict[str, Any]) -> Tuple[float, float, float]:
+        # Закэшированный в fast_move_session() status не знает текущей позиции — спрашиваем только её
+        if status is self._preflight_status:
+            pos = self._query_position()
+        else:
+            pos = status["toolhead"]["position"]  # [x,y,z,e]
+        return float(pos[0]), float(pos[1]), float(pos[2])
+
+    @contextmanager
+    def fast_move_session(self, axes: str = "xyz") -> Iterator[None]:
+        """
+        Проверяет готовность/хоминг/пределы один раз и не повторяет их внутри блока:
+
+            with p.fast_move_session():
+                for x, y in points:
+                    p.move_absolute(x=x, y=y, z=z, speed_mm_s=v)
+
+        Пределы поля с насадкой по-прежнему проверяются для каждой точки.
+        Если принтер внутри блока перейдёт в shutdown, ошибку вернёт уже сам POST G-code.
+        """
+        if self._preflight_status is not None:
+            yield
+            return
+        self._preflight_status = self._preflight(axes)
+        try:
+            yield
+        finally:
+            self._preflight_status = None
+
+    def wait_moves_m400(self) -> None:
+        self.wait_moves()
+
+    def wait_moves(self, timeout: Optional[float] = None) -> None:
+        """
+        Ждём окончания движений на стороне Klipper: M400 блокирует очередь G-code,
+        и Moonraker отвечает на POST только когда очередь опустеет.
+        timeout — ожидаемая длительность оставшегося движения, с; HTTP-таймаут — params.timeout + timeout.
+        """
+        self.send_gcode("M400", motion_s=timeout)
+
+    def _motion_timeout(self, duration_s: float) -> float:
+        # HTTP-таймаут для скрипта с M400: POST вернётся только после окончания движения
+        return self.params.timeout + max(0.0, float(duration_s))
+
+    def _wait_moves_poll(self, poll_interval: float = 0.2, timeout: float = 120.0) -> None:
+        # Старый вариант с опросом toolhead.moving — когда нужен жёсткий таймаут по времени
+        t0 = time.time()
+        while True:
+            st = self.query_status()
+            if not bool(st.get("toolhead", {}).get("moving", False)):
+                return
+            if time.time() - t0 > timeout:
+                raise PrinterError("Timeout waiting for moves to finish")
+            time.sleep(poll_interval)
+
+    def get_name(self):
+        result=self._get('/printer/info')
+        return result['hostname']
+
+    def get_position(self, *, source: Literal["toolhead", "gcode_move"] = "toolhead"):
+        """
+        Возвращает текущие координаты.
+    
+        source="toolhead":
+          printer.toolhead.position -> обычно "реальная" позиция по кинематике/степперам, [x,y,z,e]
+        source="gcode_move":
+          printer.gcode_move.position -> позиция в координатах gcode (с учетом G92/смещений), [x,y,z,e]
+    
+        Практически:
+          - для контроля фактического положения головы: toolhead
+          - если важны именно G-code координаты (после G92 и т.п.): gcode_move
+        """
+        self._ensure_ready()
+    
+        if source == "toolhead":
+            pos = self._query_position()  # [x,y,z,e]
+        else:
+            st = self._get(
+                "/printer/objects/query",
+                params={"gcode_move": "position,homing_origin"},
+            )["result"]["status"]
+            gm = st["gcode_move"]
+            pos = gm["position"]  # [x,y,z,e]
+    
+        return {"x": float(pos[0]), "y": float(pos[1]), "z": float(pos[2]), "e": float(pos[3])}
+
+    # ---------------- Init / limits cache ----------------
+    def refresh_limits(self, status: Optional[Dict[str, Any]] = None) -> None:
+        st = self.query_status() if status is None else status
+        mn = st["toolhead"]["axis_minimum"]  # [xmin,ymin,zmin,emin]
+        mx = st["toolhead"]["axis_maximum"]  # [xmax,ymax,zmax,emax]
+        self._limits = (
+            (float(mn[0]), float(mx[0])),
+            (float(mn[1]), float(mx[1])),
+            (float(mn[2]), float(mx[2])),
+        )
+
+    def get_limits_cached(self) -> Tuple[Tuple[float, float], Tuple[float, float], Tuple[float, float]]:
+        # axis_minimum/axis_maximum — статичные значения конфига Klipper: читаем один раз (например, при auto_init=False)
+        if self._limits is None:
+            self.refresh_limits()
+        return self._limits
+
+    def _query_objects(self, objects: Dict[str, Any]) -> Dict[str, Any]:
+        """
+        Low-level helper to query arbitrary Klipper objects via Moonraker.
+        Example: objects={"heater_bed": None, "temperature_sensor chamber": None}
+        """
+        if len(objects) == 1:
+            key = next(iter(objects))
+            params = self._single_query_params.get(key)
+            if params is None:
+                params = self._single_query_params[key] = {key: ""}
+        else:
+            params = dict.fromkeys(objects, "")
+        return self._get("/printer/objects/query", params=params)["result"]["status"]
+
+    # ---------------- G-code ----------------
+    def send_gcode(self, script: str, *, motion_s: Optional[float] = None) -> None:
+        """
+        motion_s — ожидаемая длительность движения скрипта, с. Для скрипта с M400 POST
+        вернётся только после окончания движения, поэтому HTTP-таймаут — params.timeout + motion_s.
+        """
+        if self._gcode_buffer is not None:
+            self._gcode_buffer.append(script)
+            if motion_s is None and "M400" in script.upper():
+                # Ожидание без оценки: отдельным POST у него было бы своё окно params.timeout
+                motion_s = self.params.timeout
+            if motion_s is not None:
+                # Скрипты пакета выполняются друг за другом: время движения суммируем,
+                # а базовый запас params.timeout добавится один раз при отправке
+                self._gcode_buffer_motion = (self._gcode_buffer_motion or 0.0) + max(0.0, float(motion_s))
+            return
+        timeout = None if motion_s is None else self._motion_timeout(motion_s)
+        try:
+            self._post("/printer/gcode/script", {"script": script}, timeout=timeout, compress=True)
+        finally:
+            # RESTART / FIRMWARE_RESTART переводят Klipper в startup — кэш готовности устарел
+            if "RESTART" in script.upper():
+                self.invalidate_info_cache()
+
+    @contextmanager
+    def gcode_batch(self) -> Iterator[None]:
+        """
+        Копит G-code из всех вызовов внутри блока и отправляет одним POST на выходе:
+
+            with p.gcode_batch():
+                p.safe_y_pass(...)
+                p.safe_y_pass(...)
+
+        Проверки (готовность, хоминг, пределы) по-прежнему выполняются при каждом вызове,
+        но по состоянию принтера ДО отправки пакета. Если в блоке возникло исключение,
+        накопленный G-code не отправляется. Вложенные gcode_batch() сливаются во внешний.
+        """
+        if self._gcode_buffer is not None:
+            yield
+            return
+        self._gcode_buffer = []
+        self._gcode_buffer_motion = None
+        try:
+            yield
+            scripts, motion_s = self._gcode_buffer, self._gcode_buffer_motion
+        finally:
+            self._gcode_buffer = None
+            self._gcode_buffer_motion = None
+        if scripts:
+            self.send_gcode("\n".join(scripts), motion_s=motion_s)
+
+    def _objects_list_cached(self, ttl: float = 30.0) -> List[str]:
+        cached = self._objects_list_cache
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1]
+        objs = self._get("/printer/objects/list")["result"]["objects"]
+        self._objects_list_cache = (time.time(), objs)
+        return objs
+
+    def _objects_list_if_fresh(self, ttl: float = 30.0) -> Optional[List[str]]:
+        # Список без сетевого запроса: только если он уже есть в кэше и не устарел
+        cached = self._objects_list_cache
+        if cached is not None and time.time() - cached[0] < ttl:
+            return cached[1]
+        return None
+
+    def find_properties(self, property_name:str) :
+        try:
+            objs = self._objects_list_cached()
+        except Exception:
+            objs = None
+
+        hint = ""
+        if isinstance(objs, list):
+            # Подскажем, что искать
+            chamber_like = [o for o in objs if property_name in o.lower()]
+            hint = f" Available objects containing {property_name}: {chamber_like}" if chamber_like else ""
+
+        return hint
+
+    # ---------------- Validation helpers ----------------
+    @staticmethod
+    def _as_float(v: Any, name: str) -> float:
+        try:
+            return float(v)
+        except Exception as e:
+            raise PrinterError(f"Cannot convert {name}='{v}' to float") from e
+
+    @staticmethod
+    def _range_check(v: float, lo: float, hi: float, name: str) -> None:
+        if v < lo or v > hi:
+            raise PrinterError(f"{name}={v:.3f} out of range [{lo:.3f}, {hi:.3f}]")
+
+    # ---------------- Motion limits ----------------
+    def set_motion_limits(self, velocity_mm_s: float, accel_mm_s2: float) -> None:
+        self._ensure_ready()
+        if velocity_mm_s <= 0 or accel_mm_s2 <= 0:
+            raise PrinterError("velocity_mm_s and accel_mm_s2 must be > 0")
+        self.send_gcode(f"SET_VELOCITY_LIMIT VELOCITY={velocity_mm_s:.3f} ACCEL={accel_mm_s2:.1f}")
@@ -31,9 +31,16 @@ z_safe=100
 z_contact=96
 
 
-for x in np.arange(300,380,10):
-    for y in np.arange(300,400,10):
-        p.safe_y_pass(x=x, y_start=y, y_end=y, z_safe=z_safe, z_contact=z_safe)
-        p.move_absolute(x=x, y=y, z=z_contact, speed_mm_s=velocity_mm_s)
-        p.move_absolute(x=x, y=y, z=z_safe, speed_mm_s=velocity_mm_s)
+# Растр (x, y) и для каждой точки тройка z_safe -> z_contact -> z_safe: массив (N*3, 3)
+X, Y = np.meshgrid(np.arange(300,380,10), np.arange(300,400,10), indexing="ij")
+pts = np.column_stack([
+    np.repeat(X.ravel(), 3),
+    np.repeat(Y.ravel(), 3),
+    np.tile([z_safe, z_contact, z_safe], X.size),
+])
+
+with p.fast_move_session():
+    # подход к первой точке через z_safe, дальше весь растр одним POST
+    p.safe_y_pass(x=pts[0][0], y_start=pts[0][1], y_end=pts[0][1], z_safe=z_safe, z_contact=z_safe)
+    p.move_path(pts, speed_mm_s=velocity_mm_s)
         
\ No newline at end of file